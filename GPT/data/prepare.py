@@ -0,0 +1,43 @@
+import os
+import numpy as np
+import tiktoken
+from tqdm import tqdm
+
+DATA_DIR = os.path.dirname(os.path.abspath(__file__))
+INPUT_PATH = os.path.join(DATA_DIR, "TinyStories-train.txt")
+OUTPUT_PATH = os.path.join(DATA_DIR, "TinyStories-train.bin")
+CHUNK_SIZE = 10000  # stories per encode_ordinary_batch call
+READ_SIZE = 64 * 1024 * 1024  # characters read from the corpus at a time, bounds host memory
+EOT_TEXT = "<|endoftext|>"
+
+enc = tiktoken.get_encoding("gpt2")
+eot = enc.eot_token
+assert enc.n_vocab < 2**16  # tokens are stored as uint16
+
+
+def iter_stories(path):
+    # yield lists of complete stories, reading the corpus in bounded pieces; the unfinished
+    # story at the end of each piece is carried over to the next one
+    tail = ""
+    with open(path, "r", encoding="utf-8") as f:
+        while block := f.read(READ_SIZE):
+            stories = (tail + block).split(EOT_TEXT)
+            tail = stories.pop()
+            if stories:
+                yield stories
+    if tail:
+        yield [tail]
+
+
+# Tokenize in parallel batches and append raw uint16 tokens, so the training
+# loader can np.memmap the result without loading it into RAM
+total = 0
+with open(OUTPUT_PATH, "wb") as out:
+    for stories in tqdm(iter_stories(INPUT_PATH), desc="Tokenizing", unit="block"):
+        for i in range(0, len(stories), CHUNK_SIZE):
+            batch = enc.encode_ordinary_batch(stories[i:i + CHUNK_SIZE], num_threads=os.cpu_count())
+            ids = np.concatenate([np.asarray(tokens + [eot], dtype=np.uint16) for tokens in batch])
+            ids.tofile(out)
+            total += len(ids)
+
+print(f"\nWrote {total} tokens to {OUTPUT_PATH}")
@@ -6,8 +6,9 @@ import math
 import os
 import sys
 import inspect
-import tiktoken
-from opacus import PrivacyEngine
+import numpy as np
+import torch.distributed as dist
+from torch.func import functional_call, grad_and_value, vmap
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
 torch.set_float32_matmul_precision("high")
 
@@ -20,6 +21,7 @@ class GPTConfig:
     n_head: int = 12
     n_embd: int = 768
     batch_size: int = 2
+    loss_chunk_size: int = 512
 
 
 class SelfAttention(nn.Module):
@@ -31,18 +33,27 @@ class SelfAttention(nn.Module):
         self.c_proj.NANOGPT_SCALE_INIT = 1.0
         self.n_head = config.n_head
         self.n_embd = config.n_embd
-        self.register_buffer("bias", torch.tril(torch.ones(config.block_size, config.block_size)).view(1, 1, config.block_size, config.block_size))
 
-    def forward(self, x):
+    def forward(self, x, kv_cache=None, start_pos=0):
         B, T, C = x.size()
-        qkv = self.c_attn(x)
-        q, k, v = qkv.split(self.n_embd, dim=2)
-        k = k.view(B, T, self.n_head, C //self.n_head).transpose(1, 2)
-        q = q.view(B, T, self.n_head, C //self.n_head).transpose(1, 2)
-        v = v.view(B, T, self.n_head, C //self.n_head).transpose(1, 2)
-        
-        y = F.scaled_dot_product_attention(q, k, v, is_causal=True)
-        y = y.transpose(1, 2).contiguous().view(B, T, C)
+        qkv = self.c_attn(x).view(B, T, 3, self.n_head, C // self.n_head)
+        qkv = qkv.permute(2, 0, 3, 1, 4)  # (3, B, nh, T, hd)
+        q, k, v = qkv.unbind(0)
+
+        is_causal = True
+        if kv_cache is not None:
+            # write the new keys/values into the preallocated cache and attend over the whole prefix;
+            # decoding one token at a time needs no mask since q only holds the newest position
+            assert start_pos == 0 or T == 1
+            k_cache, v_cache = kv_cache
+            k_cache[:, :, start_pos:start_pos + T] = k
+            v_cache[:, :, start_pos:start_pos + T] = v
+            k = k_cache[:, :, :start_pos + T]
+            v = v_cache[:, :, :start_pos + T]
+            is_causal = start_pos == 0
+
+        y = F.scaled_dot_product_attention(q, k, v, is_causal=is_causal)
+        y = y.transpose(1, 2).reshape(B, T, C)
         return self.c_proj(y)
 
 
@@ -54,8 +65,8 @@ class Block(nn.Module):
 		self.attn = SelfAttention(config)
 		self.mlp = MLP(config)
 
-	def forward(self, x):
-		x = x + self.attn(self.ln_1(x))
+	def forward(self, x, kv_cache=None, start_pos=0):
+		x = x + self.attn(self.ln_1(x), kv_cache, start_pos)
 		x = x + self.mlp(self.ln_2(x))
 		return x
 
@@ -66,12 +77,49 @@ class MLP(nn.Module):
         self.c_fc = nn.Linear(config.n_embd, config.n_embd*4)
         self.c_proj = nn.Linear(config.n_embd*4, config.n_embd)
         self.c_proj.NANOGPT_SCALE_INIT = 1.0
-        self.gelu = nn.GELU()
+        self.gelu = nn.GELU(approximate='tanh')
         
     def forward(self, x):
         return self.c_proj(self.gelu(self.c_fc(x)))
 
 
+class FusedLinearCrossEntropy(torch.autograd.Function):
+    # Tied lm_head projection + mean cross-entropy over (N, C) inputs, computed chunk_size rows
+    # at a time. The gradients w.r.t. x and W are formed chunk by chunk during forward, so only one
+    # (chunk_size, vocab_size) logits block is alive at once and nothing is kept for backward but
+    # the gradients themselves. Written out of place so it can run under vmap(grad(...)).
+    generate_vmap_rule = True
+
+    @staticmethod
+    def forward(x, W, targets, chunk_size):
+        N = x.size(0)
+        loss = 0.0
+        grad_x = []
+        grad_W = torch.zeros_like(W, dtype=torch.float32)
+        for start in range(0, N, chunk_size):
+            x_chunk = x[start:start + chunk_size]
+            t_chunk = targets[start:start + chunk_size, None]
+            logits = F.linear(x_chunk, W).float()
+            lse = torch.logsumexp(logits, dim=-1, keepdim=True)
+            loss = loss + (lse - logits.gather(1, t_chunk)).sum()
+            # d(mean CE)/d(logits) = (softmax - onehot) / N
+            dlogits = torch.exp(logits - lse).scatter_add(1, t_chunk, -torch.ones_like(lse)) / N
+            grad_x.append((dlogits.to(x.dtype) @ W))
+            grad_W = grad_W + dlogits.t() @ x_chunk.float()
+        return loss / N, torch.cat(grad_x), grad_W.to(W.dtype)
+
+    @staticmethod
+    def setup_context(ctx, inputs, output):
+        _, grad_x, grad_W = output
+        ctx.mark_non_differentiable(grad_x, grad_W)
+        ctx.save_for_backward(grad_x, grad_W)
+
+    @staticmethod
+    def backward(ctx, grad_loss, _grad_x, _grad_W):
+        grad_x, grad_W = ctx.saved_tensors
+        return grad_x * grad_loss, grad_W * grad_loss, None, None
+
+
 class GPT(nn.Module):
     def __init__(self, config: GPTConfig):
         super().__init__()  
@@ -82,9 +130,7 @@ class GPT(nn.Module):
             h = nn.ModuleList([Block(config) for _ in range(config.n_layer)]),
             ln_f = nn.LayerNorm(config.n_embd)
         ))
-        self.lm_head = nn.Linear(config.n_embd, config.vocab_size, bias=False)
-
-        self.transformer.wte.weight = self.lm_head.weight
+        self.register_buffer("pos_ids", torch.arange(config.block_size), persistent=False)
 
         self.apply(self._init_weights)
 
@@ -100,30 +146,66 @@ class GPT(nn.Module):
         elif isinstance(module, nn.Embedding):
             torch.nn.init.normal_(module.weight, mean=0, std=std)
             
-    def forward(self, idx, targets=None):
+    def forward(self, idx, targets=None, kv_caches=None, start_pos=0):
         B, T = idx.size()
-        assert T <= self.config.block_size 
-        pos = torch.arange(T, dtype=torch.long, device=idx.device)
-        pos_emb = self.transformer['wpe'](pos)
+        assert start_pos + T <= self.config.block_size 
+        pos_emb = self.transformer['wpe'](self.pos_ids[start_pos:start_pos + T])
         tok_emb = self.transformer['wte'](idx)
         x = pos_emb + tok_emb
-        for block in self.transformer['h']:
-            x = block(x)
+        for i, block in enumerate(self.transformer['h']):
+            x = block(x, kv_caches[i] if kv_caches is not None else None, start_pos)
         x = self.transformer['ln_f'](x)
-        logits = self.lm_head(x)
-        
+        # lm_head is tied to wte, so project with the embedding weight directly
+        W = self.transformer['wte'].weight
+
         if targets is not None:
-            loss = F.cross_entropy(logits.view(-1, logits.size(-1)), targets.view(-1))
+            # fused projection + cross-entropy: the full (B*T, vocab_size) logits are never materialized
+            logits = None
+            loss, _, _ = FusedLinearCrossEntropy.apply(
+                x.view(-1, x.size(-1)), W, targets.reshape(-1), self.config.loss_chunk_size
+            )
         else: 
+            logits = F.linear(x, W)
             loss = None
         return logits, loss
   
+    def allocate_kv_cache(self, batch_size: int, max_seq_len: int) -> list:
+        # one (k, v) pair per layer, each (B, nh, max_seq_len, hd)
+        cfg = self.config
+        assert max_seq_len <= cfg.block_size
+        weight = self.transformer['wte'].weight
+        shape = (batch_size, cfg.n_head, max_seq_len, cfg.n_embd // cfg.n_head)
+        return [
+            (torch.empty(shape, dtype=weight.dtype, device=weight.device),
+             torch.empty(shape, dtype=weight.dtype, device=weight.device))
+            for _ in range(cfg.n_layer)
+        ]
+
+    @torch.no_grad()
     def generate(self, x: torch.Tensor, max_len: int = 100) -> torch.Tensor:
-        for _ in range(max_len):
-            logits = self(x[:, -self.config.block_size:])
-            next_token = logits[:, -1].argmax(dim=-1, keepdim=True)
-            x = torch.cat([x, next_token], dim=1)
-        return x
+        # write tokens into a preallocated buffer instead of re-concatenating the prefix
+        B, T0 = x.shape
+        block_size = self.config.block_size
+        buf = torch.empty(B, T0 + max_len, dtype=x.dtype, device=x.device)
+        buf[:, :T0] = x
+
+        # prefill the KV cache with the prompt, then feed one new token per step
+        cache_len = min(block_size, T0 + max_len)
+        kv_caches = self.allocate_kv_cache(B, cache_len)
+        start = max(0, T0 - block_size)
+        logits, _ = self(buf[:, start:T0], kv_caches=kv_caches)
+        pos = T0 - start
+        for cur in range(T0, T0 + max_len):
+            buf[:, cur] = logits[:, -1].argmax(dim=-1)
+            if cur + 1 == T0 + max_len:
+                break
+            if pos < cache_len:
+                logits, _ = self(buf[:, cur:cur + 1], kv_caches=kv_caches, start_pos=pos)
+                pos += 1
+            else:
+                # the cache is full and positions are absolute, so fall back to the sliding window
+                logits, _ = self(buf[:, cur + 1 - block_size:cur + 1])
+        return buf
 
     def configure_optimizers(self, weight_decay, learning_rate, device):
         param_dict = {pn: p for pn, p in self.named_parameters()}
@@ -148,35 +230,52 @@ class GPT(nn.Module):
 
 
 class DataLoaderLite:
-    def __init__(self, B, T):
+    def __init__(self, B, T, device=device, process_rank=0):
         self.B = B
         self.T = T
+        # seeded per rank so DDP processes draw different windows
+        self.generator = torch.Generator().manual_seed(1337 + process_rank)
+        self.device = device
+        self.pin = 'cuda' in device
+        self.copy_stream = torch.cuda.Stream() if self.pin else None
 
-        data_path = os.path.join(os.path.dirname(__file__), 'data', 'TinyStories-train.txt')
-
-        with open(data_path, 'r') as f:
-            data = f.read()
-        enc = tiktoken.get_encoding('gpt2')
-        tokens = enc.encode(data, allowed_special={"<|endoftext|>"})
-        self.tokens = torch.tensor(tokens, dtype=torch.long)
+        # pre-tokenized by data/prepare.py; memory-mapped so host memory stays flat
+        data_path = os.path.join(os.path.dirname(__file__), 'data', 'TinyStories-train.bin')
+        self.tokens = np.memmap(data_path, dtype=np.uint16, mode='r')
 
         print(f"Total tokens: {len(self.tokens)}")
         print(f"1 epoch = {len(self.tokens) // (B * T)} batches")
 
-        self.current = 0
-
     def next_batch(self):
         B, T = self.B, self.T
-        buff = self.tokens[self.current:self.current + B * T + 1]
-        x = buff[:-1].view(B, T)
-        y = buff[1:].view(B, T)
-        self.current += B * T
-
-        if self.current + B * T + 1 >= len(self.tokens):
-            self.current = 0
-
+        # sample B windows at uniformly random offsets
+        ix = torch.randint(len(self.tokens) - T - 1, (B,), generator=self.generator).tolist()
+        # keep int32 on the host and widen to int64 on the device to halve H2D traffic
+        x = torch.from_numpy(np.stack([self.tokens[i:i + T] for i in ix]).astype(np.int32))
+        y = torch.from_numpy(np.stack([self.tokens[i + 1:i + 1 + T] for i in ix]).astype(np.int32))
+        if self.pin:
+            x, y = x.pin_memory(), y.pin_memory()
         return x, y 
 
+    def prefetch(self):
+        # issue the H2D copy of the next batch on a side stream so it overlaps with compute
+        x, y = self.next_batch()
+        if self.copy_stream is None:
+            return x.to(self.device).long(), y.to(self.device).long()
+        with torch.cuda.stream(self.copy_stream):
+            x = x.to(self.device, non_blocking=True).long()
+            y = y.to(self.device, non_blocking=True).long()
+        return x, y
+
+    def wait(self, x, y):
+        # make the compute stream wait for a prefetched batch before using it
+        if self.copy_stream is not None:
+            stream = torch.cuda.current_stream()
+            stream.wait_stream(self.copy_stream)
+            x.record_stream(stream)
+            y.record_stream(stream)
+        return x, y
+
     
 def get_lr(it):
     if it < warmup_steps:
@@ -188,16 +287,55 @@ def get_lr(it):
     coeff = 0.5 * (1 + math.cos(math.pi * decay_ratio))
     return min_lr + coeff * (max_lr - min_lr)
 
+def dp_sgd_grads(model: nn.Module, max_grad_norm: float):
+    # DP-SGD with torch.func: per-sample gradients come from one vmapped backward
+    # (no Opacus hooks), each is clipped to max_grad_norm and the batch is summed
+    def compute_loss(params, x, y):
+        _, loss = functional_call(model, params, (x.unsqueeze(0), y.unsqueeze(0)))
+        return loss
+
+    per_sample_grads = vmap(grad_and_value(compute_loss), in_dims=(None, 0, 0))
+
+    def clipped_grads(params, x, y):
+        grads, losses = per_sample_grads(params, x, y)
+        norms = torch.stack([g.float().flatten(1).norm(dim=1) for g in grads.values()]).norm(dim=0)
+        scale = (max_grad_norm / (norms + 1e-6)).clamp(max=1.0)
+        clipped = {n: torch.einsum('b,b...->...', scale, g.float()) for n, g in grads.items()}
+        return clipped, losses.mean()
+
+    return clipped_grads
+
 def add_noise_to_input(input_ids: torch.Tensor, noise: float=.1) -> torch.Tensor:
-    noise_tensor = torch.normal(mean=0.0, std=noise, size=input_ids.size(), device=input_ids.device)
-    return input_ids + noise_tensor
+    # sample at the target std and add in place, so the noise tensor doubles as the output;
+    # the dtype matches what input_ids + float noise used to return
+    dtype = torch.promote_types(input_ids.dtype, torch.get_default_dtype())
+    return torch.empty(input_ids.size(), dtype=dtype, device=input_ids.device).normal_(0.0, noise).add_(input_ids)
 
             
 if __name__ == "__main__":
 
-    from torch import autocast
     import time
-    
+
+    # launched via torchrun when RANK is set, otherwise a single process
+    ddp = int(os.environ.get('RANK', -1)) != -1
+    if ddp:
+        dist.init_process_group(backend="nccl")
+        ddp_rank = int(os.environ['RANK'])
+        ddp_local_rank = int(os.environ['LOCAL_RANK'])
+        ddp_world_size = int(os.environ['WORLD_SIZE'])
+        device = f'cuda:{ddp_local_rank}'
+        torch.cuda.set_device(device)
+    else:
+        ddp_rank = 0
+        ddp_local_rank = 0
+        ddp_world_size = 1
+    master_process = ddp_rank == 0
+
+    if 'cuda' in device:
+        # restrict SDPA to the fused flash / memory-efficient kernels; set globally rather than
+        # with sdpa_kernel() in forward so Dynamo does not have to trace a context manager
+        torch.backends.cuda.enable_math_sdp(False)
+
     max_steps = 100
     max_lr = 6e-4
     min_lr = 0.1 * max_lr    
@@ -209,50 +347,108 @@ if __name__ == "__main__":
     B = config.batch_size
     T = config.block_size
 
-    assert total_batch_size % (B * T) == 0
-    grad_accum_steps = total_batch_size // (B * T)
+    assert total_batch_size % (B * T * ddp_world_size) == 0
+    grad_accum_steps = total_batch_size // (B * T * ddp_world_size)
 
     
-    model = GPT(config).to(device)    
-    
-    train_loader = DataLoaderLite(config.batch_size, config.block_size)
+    # fp32 master weights for the optimizer; the DP step runs on a bf16 copy below
+    model = GPT(config).to(device)
+    if ddp:
+        # every rank initialises its own random weights; start all of them from rank 0's
+        for p in model.parameters():
+            dist.broadcast(p.data, 0)
+
+    train_loader = DataLoaderLite(config.batch_size, config.block_size, device, ddp_rank)
 
     model_dict_path = os.path.join(os.path.dirname(__file__), "model.ptl")
 
     optimizer = model.configure_optimizers(0.1, 6e-4, device)
-    
-    privacy_engine = PrivacyEngine()
-    
-    model, optimizer, train_loader = privacy_engine.make_private(
-        module=model,
-        optimizer=optimizer,
-        data_loader=train_loader,
-        noise_multiplier=1.0,  # Adjust based on privacy requirements
-        max_grad_norm=1.0      # Clipping threshold
-    )
+
+    noise_multiplier = 1.0  # Adjust based on privacy requirements
+    max_grad_norm = 1.0     # Clipping threshold
+    num_samples = total_batch_size // T  # sequences contributing to one optimizer step
+
+    # bf16 compute copy of the fp32 master weights: weights are read at half the bandwidth
+    # and no autocast is needed. It is refreshed in place after every optimizer step.
+    param_list = [p for p in model.parameters() if p.requires_grad]
+    params = {n: p.detach().to(torch.bfloat16) for n, p in model.named_parameters() if p.requires_grad}
+    dp_step = torch.compile(dp_sgd_grads(model, max_grad_norm), dynamic=False)
+    # static fp32 gradient accumulators: the captured graphs write into the same memory on every
+    # replay. The first micro-step of a step overwrites them, so they never need zeroing.
+    # They are views into one flat tensor so noise and the cross-rank all-reduce are single calls.
+    grad_flat = torch.empty(sum(p.numel() for p in param_list), dtype=torch.float32, device=device)
+    grad_bufs = [g.view_as(p) for g, p in zip(grad_flat.split([p.numel() for p in param_list]), param_list)]
+
+    def micro_step(x, y, first):
+        grads, loss = dp_step(params, x, y)
+        if first:
+            torch._foreach_copy_(grad_bufs, list(grads.values()))
+        else:
+            torch._foreach_add_(grad_bufs, list(grads.values()))
+        return loss
 
     # Calculate number of parameters
     num_params = sum(p.numel() for p in model.parameters())
-    print(f"Number of parameters: {num_params}")
-
-    loss_accum = 0.0
+    if master_process:
+        print(f"Number of parameters: {num_params}")
+
+    # warmup outside the timed loop to absorb compile latency
+    static_x, static_y = train_loader.wait(*train_loader.prefetch())
+    graphs = None
+    if 'cuda' in device:
+        # shapes are static, so warm up on a side stream and capture the micro-step as CUDA graphs:
+        # one that writes the accumulators (first micro-step) and one that adds into them
+        side_stream = torch.cuda.Stream()
+        side_stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(side_stream):
+            for i in range(3):
+                micro_step(static_x, static_y, first=i == 0)
+        torch.cuda.current_stream().wait_stream(side_stream)
+        graphs = {}
+        static_loss = {}
+        pool = None
+        for first in (True, False):
+            graphs[first] = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(graphs[first], pool=pool):
+                static_loss[first] = micro_step(static_x, static_y, first)
+            pool = graphs[first].pool()
+    else:
+        micro_step(static_x, static_y, first=True)
+
+    # double buffer: the next batch is always in flight while the current one computes
+    batch = train_loader.prefetch()
 
     for step in range(max_steps):
         
-        optimizer.zero_grad()
+        optimizer.zero_grad(set_to_none=True)
 
         t0 = time.time()
 
+        # accumulate on device so the micro-steps never sync with the host
+        loss_accum_t = torch.zeros((), device=device)
         for mikro_step in range(grad_accum_steps):
         
-            x, y = train_loader.next_batch()
-            x, y = x.to(device), y.to(device)
-            with autocast("cuda", dtype=torch.bfloat16):
-                logits, loss = model(x, y)
-
-            loss = loss / grad_accum_steps
-            loss_accum += loss.detach().item()
-            loss.backward()
+            x, y = train_loader.wait(*batch)
+            batch = train_loader.prefetch()
+            first = mikro_step == 0
+            if graphs is not None:
+                static_x.copy_(x)
+                static_y.copy_(y)
+                graphs[first].replay()
+                loss = static_loss[first]
+            else:
+                loss = micro_step(x, y, first)
+            loss_accum_t += loss / grad_accum_steps
+
+        for p, buf in zip(param_list, grad_bufs):
+            p.grad = buf
+
+        # Gaussian noise calibrated to the clipping bound, added once per step (on one rank only)
+        if master_process:
+            grad_flat.add_(torch.randn_like(grad_flat), alpha=noise_multiplier * max_grad_norm)
+        if ddp:
+            dist.all_reduce(grad_flat)
+        grad_flat.div_(num_samples)
 
         norm = torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
 
@@ -262,10 +458,18 @@ if __name__ == "__main__":
             param_group['lr'] = lr
             
         optimizer.step()
+        torch._foreach_copy_(list(params.values()), param_list)
+        if ddp:
+            dist.all_reduce(loss_accum_t, op=dist.ReduceOp.AVG)
+        loss_accum = loss_accum_t.item()
         torch.cuda.synchronize()
 
         t1 = time.time()
-        print(f"Step {step} | Loss: {loss_accum:.4f} | lr {lr:.6f} | Norm: {norm:.4f} | Time: {(t1 - t0)*1000:.4f}ms")
+        if master_process:
+            print(f"Step {step} | Loss: {loss_accum:.4f} | lr {lr:.6f} | Norm: {norm:.4f} | Time: {(t1 - t0)*1000:.4f}ms")
 
 
-    torch.save(model.state_dict(), model_dict_path)
+    if master_process:
+        torch.save(model.state_dict(), model_dict_path)
+    if ddp:
+        dist.destroy_process_group()